@@ -1,23 +1,45 @@
 import os
 import time
 import sys
+import fcntl
+import hmac
 import logging
+import threading
+import atexit
+import queue
+from collections import OrderedDict
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from flask import Flask, request, jsonify
 from apscheduler.schedulers.background import BackgroundScheduler
-from rentmax_analysis import process_all_files, post_journey_to_apps_script
 import requests
-import json
-import pandas as pd
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import orjson
 
 app = Flask(__name__)
+# WATI payloads are a few KB; reject anything far larger before reading it.
+app.config["MAX_CONTENT_LENGTH"] = 64 * 1024
 logging.basicConfig(level=logging.INFO)
 
 ############################################
 # Environment Variables for Zoho Credentials
 ############################################
 LOG_FOLDER = os.environ.get("LOG_FOLDER", "logs")
-os.makedirs(LOG_FOLDER, exist_ok=True)
+LOG_FOLDER_ABS = os.path.abspath(LOG_FOLDER)
 WEBHOOK_TOKEN = os.environ.get("WATI_WEBHOOK_TOKEN", "default_token")
+_WEBHOOK_TOKEN_BYTES = WEBHOOK_TOKEN.encode("utf-8")
+# Maximum number of log lines waiting for the background writer.
+LOG_QUEUE_SIZE = 10000
+# Maximum number of log lines the background writer handles in one pass.
+LOG_WRITE_BATCH = 256
+# Seconds the background writer waits for more lines after the first one.
+LOG_WRITE_WINDOW = 0.1
+# Maximum number of per-waId log file descriptors kept open.
+LOG_FD_CACHE_SIZE = 1024
+# Touched after every written batch; its mtime is the time of the last log
+# write in any worker process.
+LAST_WRITE_MARKER = f"{LOG_FOLDER_ABS}/.last_write"
 
 # Zoho OAuth & API credentials (for India data center)
 ZOHO_CLIENT_ID = os.environ.get("ZOHO_CLIENT_ID")
@@ -25,6 +47,43 @@ ZOHO_CLIENT_SECRET = os.environ.get("ZOHO_CLIENT_SECRET")
 ZOHO_REDIRECT_URI = os.environ.get("ZOHO_REDIRECT_URI")  # e.g. "https://wati-sheets-crm.onrender.com/oauth/callback"
 ZOHO_REFRESH_TOKEN = os.environ.get("ZOHO_REFRESH_TOKEN")
 
+ZOHO_TOKEN_URL = "https://accounts.zoho.in/oauth/v2/token"
+ZOHO_LEADS_URL = "https://www.zohoapis.in/crm/v2/Leads"
+ZOHO_SEARCH_URL = "https://www.zohoapis.in/crm/v2/Leads/search"
+# Search clause shared by every lead lookup; only WATI leads are ever updated.
+_LEAD_SRC_CLAUSE = "(Lead_Source:equals:WATI)"
+
+# Maximum number of leads searched for and updated per Zoho CRM call.
+ZOHO_BATCH_SIZE = 100
+# process_logs runs once the logs have been quiet for PROCESS_QUIET_SECONDS
+# after a write, or PROCESS_MAX_DELAY_SECONDS after the previous run if writes
+# keep coming; the scheduler checks for that every PROCESS_POLL_SECONDS.
+PROCESS_QUIET_SECONDS = int(os.environ.get("PROCESS_QUIET_SECONDS", 10))
+PROCESS_MAX_DELAY_SECONDS = int(os.environ.get("PROCESS_MAX_DELAY_SECONDS", 60))
+PROCESS_POLL_SECONDS = int(os.environ.get("PROCESS_POLL_SECONDS", 5))
+# rentmax_analysis holds back a session until its last message is 7 minutes
+# old, so one more run is needed once that has passed after the last write.
+# The slack covers WATI timestamps running a little ahead of this server's clock.
+SESSION_HOLD_SECONDS = 7 * 60
+SESSION_HOLD_SLACK_SECONDS = 30
+# Number of journeys posted to Google Sheets concurrently per scheduled run.
+SHEETS_MAX_WORKERS = int(os.environ.get("SHEETS_MAX_WORKERS", 32))
+
+# Shared HTTP session so the TCP/TLS connections to Zoho are kept alive and
+# reused across token refreshes, searches and updates.
+ZOHO_SESSION = requests.Session()
+ZOHO_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=50,
+    max_retries=Retry(total=3, backoff_factor=0.2, status_forcelist=(429, 500, 502, 503, 504), raise_on_status=False)
+))
+
+# In-process cache of the Zoho access token (valid for ~1 hour) so a batch of
+# journeys shares one refresh instead of refreshing per lead. Held as one
+# (token, expires_at) tuple so readers never see a token with another's expiry.
+_zoho_token = (None, 0.0)
+_TOKEN_LOCK = threading.Lock()
+
 ############################################
 # Hardcoded Zoho Field API Keys
 ############################################
@@ -42,57 +101,278 @@ RENT_TENANT_EST_MOVE_IN_FIELD = "Rent_Tenant_Est_Move_In"
 # INTRO_SELECTION_FIELD = "Intro_Selection"
 # MAIN_SELECTION_FIELD = "Main_Selection"
 
+# Mapping from Zoho CRM field -> journey dict key, in the order sent to Zoho.
+# Add more (field, key) pairs here if needed, e.g. (INTRO_SELECTION_FIELD, "intro_selection").
+ZOHO_FIELD_MAP = (
+    (JOURNEY_ATTEMPTS_FIELD, "journey_attempts"),
+    (RENT_TENANT_CITY_FIELD, "rent_tenant_btn_city"),
+    (RENT_TENANT_CONFIG_FIELD, "rent_tenant_btn_configuration"),
+    (RENT_TENANT_CONFIG_MORE_FIELD, "rent_tenant_btn_configuration_more"),
+    (RENT_TENANT_LOCALITY_FIELD, "rent_tenant_txt_locality"),
+    (RENT_TENANT_BUDGET_WRONG_FIELD, "rent_tenant_txt_budget_wrong"),
+    (RENT_TENANT_BUDGET_CORRECT_FIELD, "rent_tenant_txt_budget_correct"),
+    (RENT_TENANT_EMAIL_FIELD, "rent_tenant_txt_email"),
+    (RENT_TENANT_EST_MOVE_IN_FIELD, "rent_tenant_btn_est_move_in"),
+)
+
+############################################
+# Background Log Writer
+############################################
+# wati_webhook only enqueues (wa_id, line_bytes); a single background thread
+# drains the queue and appends the lines, grouped per waId file.
+_log_queue = None
+_log_write_lock = None
+_log_writer_thread = None
+# Queued by close_log_fds to make the writer flush its batch and exit.
+_LOG_WRITER_STOP = object()
+# Raw O_APPEND descriptors per waId, least recently used first.
+_log_fds = OrderedDict()
+# Most buffers one writev(2) call accepts; POSIX guarantees at least 16, and
+# sysconf reports -1 where there is no fixed limit.
+try:
+    _IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError):
+    _IOV_MAX = -1
+if _IOV_MAX < 16:
+    _IOV_MAX = 16
+
+def _get_log_fd(wa_id):
+    """Returns a cached append descriptor for wa_id's log file. Caller holds _log_write_lock."""
+    fd = _log_fds.get(wa_id)
+    if fd is not None:
+        _log_fds.move_to_end(wa_id)
+        return fd
+    if len(_log_fds) >= LOG_FD_CACHE_SIZE:
+        _, old_fd = _log_fds.popitem(last=False)
+        os.close(old_fd)
+    log_file = f"{LOG_FOLDER_ABS}/{wa_id}.txt"
+    try:
+        fd = os.open(log_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    except FileNotFoundError:
+        # First write since the log folder was created or removed.
+        os.makedirs(LOG_FOLDER_ABS, exist_ok=True)
+        fd = os.open(log_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    _log_fds[wa_id] = fd
+    return fd
+
+def _append_lines(fd, lines):
+    """
+    Appends lines to fd, using one writev(2) call per _IOV_MAX lines where the
+    platform has it (writev fails with EINVAL beyond that many buffers).
+    """
+    if not hasattr(os, "writev"):
+        _write_all(fd, memoryview(b"".join(lines)))
+        return
+    for i in range(0, len(lines), _IOV_MAX):
+        chunk = lines[i:i + _IOV_MAX]
+        written = os.writev(fd, chunk)
+        if written != sum(map(len, chunk)):
+            _write_all(fd, memoryview(b"".join(chunk))[written:])
+
+def _write_all(fd, buf):
+    """Writes the whole of buf to fd, retrying after short writes."""
+    while buf:
+        buf = buf[os.write(fd, buf):]
+
+def _write_log_group(items):
+    """Appends a batch of (wa_id, line_bytes) items, one write per waId file."""
+    grouped = {}
+    for wa_id, line_bytes in items:
+        grouped.setdefault(wa_id, []).append(line_bytes)
+    with _log_write_lock:
+        for wa_id, lines in grouped.items():
+            try:
+                _append_lines(_get_log_fd(wa_id), lines)
+            except Exception as e:
+                app.logger.error("Error writing log for %s: %s", wa_id, e)
+        _touch_last_write_marker()
+
+def _touch_last_write_marker():
+    """Bumps LAST_WRITE_MARKER's mtime so the scheduler sees new writes from any worker."""
+    try:
+        os.utime(LAST_WRITE_MARKER)
+    except FileNotFoundError:
+        try:
+            os.close(os.open(LAST_WRITE_MARKER, os.O_WRONLY | os.O_CREAT, 0o644))
+        except OSError as e:
+            app.logger.error("Error creating %s: %s", LAST_WRITE_MARKER, e)
+    except OSError as e:
+        app.logger.error("Error touching %s: %s", LAST_WRITE_MARKER, e)
+
+def _log_writer_loop():
+    stopping = False
+    while not stopping:
+        items = [_log_queue.get()]
+        # Keep collecting for up to LOG_WRITE_WINDOW so a burst is written together.
+        deadline = time.monotonic() + LOG_WRITE_WINDOW
+        while len(items) < LOG_WRITE_BATCH:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = _log_queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            items.append(item)
+            if item is _LOG_WRITER_STOP:
+                break
+        if items[-1] is _LOG_WRITER_STOP:
+            items.pop()
+            stopping = True
+        if not items:
+            continue
+        # This is the process's only writer; a bad batch must not end the thread.
+        try:
+            _write_log_group(items)
+        except Exception as e:
+            app.logger.error("Error writing %d log lines: %s", len(items), e)
+
+def drain_log_queue():
+    """Writes out every log line still waiting in the queue."""
+    items = []
+    while True:
+        try:
+            item = _log_queue.get_nowait()
+        except queue.Empty:
+            break
+        if item is not _LOG_WRITER_STOP:
+            items.append(item)
+    if items:
+        _write_log_group(items)
+
+def close_log_fds():
+    """
+    Stops the writer thread once it has written the batch it is holding,
+    writes out the lines still queued and closes every cached log descriptor.
+    """
+    try:
+        _log_queue.put(_LOG_WRITER_STOP, timeout=5)
+        _log_writer_thread.join(timeout=5)
+    except queue.Full:
+        app.logger.error("Log queue full at exit; not waiting for the log writer.")
+    drain_log_queue()
+    with _log_write_lock:
+        while _log_fds:
+            _, fd = _log_fds.popitem()
+            os.close(fd)
+
+def _start_log_writer():
+    """
+    Creates this process's log queue, lock and descriptor cache and starts its
+    writer thread. Also runs in every forked child (e.g. gunicorn workers with
+    --preload), since threads and locks do not survive fork and inherited
+    descriptors must not be shared with the parent.
+    """
+    global _log_queue, _log_write_lock, _log_writer_thread
+    _log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    _log_write_lock = threading.Lock()
+    while _log_fds:
+        _, fd = _log_fds.popitem()
+        os.close(fd)
+    _log_writer_thread = threading.Thread(target=_log_writer_loop, name="log-writer", daemon=True)
+    _log_writer_thread.start()
+
+_start_log_writer()
+os.register_at_fork(after_in_child=_start_log_writer)
+atexit.register(close_log_fds)
+
 ############################################
 # Flask Endpoints
 ############################################
 
+# (epoch day, "YYYY-MM-DD") of the most recently formatted webhook timestamp.
+_last_epoch_day = (None, "")
+# (epoch second, formatted string) of the most recently formatted webhook timestamp.
+_last_epoch_str = (None, "")
+
+def _format_epoch(epoch_ts):
+    """
+    Formats an epoch timestamp as "YYYY-MM-DD HH:MM:SS" in UTC, which is how
+    rentmax_analysis interprets log timestamps. Messages in a burst usually
+    share a second, so the last result is reused; the date part is only
+    recomputed when the day changes.
+    """
+    global _last_epoch_day, _last_epoch_str
+    cached_ts, cached_str = _last_epoch_str
+    if epoch_ts == cached_ts:
+        return cached_str
+    day, sec_of_day = divmod(epoch_ts, 86400)
+    cached_day, date_str = _last_epoch_day
+    if day != cached_day:
+        date_str = time.strftime("%Y-%m-%d", time.gmtime(day * 86400))
+        _last_epoch_day = (day, date_str)
+    h, rem = divmod(sec_of_day, 3600)
+    m, s = divmod(rem, 60)
+    time_str = f"{date_str} {h:02d}:{m:02d}:{s:02d}"
+    _last_epoch_str = (epoch_ts, time_str)
+    return time_str
+
+# Fixed webhook response bodies, serialized once at import.
+_RECEIVED_BODY = orjson.dumps({"status": "received"})
+_FORBIDDEN_BODY = orjson.dumps({"status": "forbidden"})
+_INVALID_JSON_BODY = orjson.dumps({"status": "invalid json"})
+_NO_DATA_BODY = orjson.dumps({"status": "no data"})
+_BUSY_BODY = orjson.dumps({"status": "busy"})
+_TOO_LARGE_BODY = orjson.dumps({"status": "payload too large"})
+
+def _json_response(body, status):
+    """Wraps a pre-serialized JSON body in a response."""
+    return app.response_class(body, status=status, mimetype="application/json")
+
+@app.errorhandler(413)
+def payload_too_large(e):
+    """Rejects bodies over MAX_CONTENT_LENGTH without reading them."""
+    app.logger.warning("Rejected %s request to %s: %s bytes exceeds the payload limit.",
+                       request.method, request.path, request.content_length)
+    return _json_response(_TOO_LARGE_BODY, 413)
+
 @app.route("/")
 def index():
     """Returns a status message and shows the log folder location."""
-    abs_log_path = os.path.abspath(LOG_FOLDER)
-    return f"Webhook is running. Log files are stored in: {abs_log_path}"
+    return f"Webhook is running. Log files are stored in: {LOG_FOLDER_ABS}"
 
 @app.route("/wati-webhook", methods=["POST"])
 def wati_webhook():
     """
     Receives webhook data from WATI, verifies the token, and appends the log line
-    to a file named after the mobile number (waId).
+    to a file named after the mobile number (waId). The line is handed to the
+    background log writer so the response does not wait on disk I/O.
     """
-    token = request.args.get("token")
-    if token != WEBHOOK_TOKEN:
-        return jsonify({"status": "forbidden"}), 403
+    token = request.args.get("token", "").encode("utf-8")
+    if not hmac.compare_digest(token, _WEBHOOK_TOKEN_BYTES):
+        return _json_response(_FORBIDDEN_BODY, 403)
 
     try:
-        data = request.get_json(force=True)
-    except Exception as e:
+        data = orjson.loads(request.get_data(cache=False))
+    except orjson.JSONDecodeError as e:
         app.logger.error("Failed to parse JSON payload: %s", e)
-        return jsonify({"status": "invalid json"}), 400
+        return _json_response(_INVALID_JSON_BODY, 400)
 
     if not data:
-        return jsonify({"status": "no data"}), 400
+        return _json_response(_NO_DATA_BODY, 400)
 
-    wa_id = data.get("waId", "unknown")
-    raw_ts = data.get("timestamp", "")
+    d_get = data.get
+    # waId names the log file, so anything other than a string (a list or an
+    # object in a malformed payload) is coerced rather than queued as is.
+    wa_id = str(d_get("waId", "unknown"))
+    raw_ts = d_get("timestamp", "")
     try:
-        epoch_ts = int(raw_ts)
-        time_str = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(epoch_ts))
+        time_str = _format_epoch(int(raw_ts))
     except Exception:
         time_str = str(raw_ts)
 
-    sender_name = data.get("operatorName", "Bot") if data.get("owner") else data.get("senderName", "User")
-    text = data.get("text", "")
-    log_line = f"[{time_str}] {sender_name}: {text}"
+    sender_name = d_get("operatorName", "Bot") if d_get("owner") else d_get("senderName", "User")
+    text = d_get("text", "")
+    log_line = f"[{time_str}] {sender_name}: {text}\n"
 
-    log_file = os.path.join(LOG_FOLDER, f"{wa_id}.txt")
     try:
-        with open(log_file, "a", encoding="utf-8") as f:
-            f.write(log_line + "\n")
-        app.logger.info("Appended log line to: %s", os.path.abspath(log_file))
-    except Exception as e:
-        app.logger.error("Error writing to %s: %s", log_file, e)
+        _log_queue.put_nowait((wa_id, log_line.encode("utf-8")))
+    except queue.Full:
+        app.logger.error("Log queue full; rejecting message for %s", wa_id)
+        return _json_response(_BUSY_BODY, 503)
 
-    app.logger.info("WATI Webhook data received: %s", data)
-    return jsonify({"status": "received"}), 200
+    app.logger.debug("WATI Webhook data received: wa_id=%s chars=%d", wa_id, len(text))
+    return _json_response(_RECEIVED_BODY, 200)
 
 @app.route("/oauth/callback")
 def oauth_callback():
@@ -105,7 +385,6 @@ def oauth_callback():
     if not code:
         return "Error: No authorization code provided.", 400
 
-    token_url = "https://accounts.zoho.in/oauth/v2/token"
     payload = {
         "code": code,
         "client_id": ZOHO_CLIENT_ID,
@@ -114,7 +393,7 @@ def oauth_callback():
         "grant_type": "authorization_code"
     }
     try:
-        response = requests.post(token_url, data=payload)
+        response = ZOHO_SESSION.post(ZOHO_TOKEN_URL, data=payload, timeout=10)
     except Exception as e:
         app.logger.error("Exception during token exchange: %s", e)
         return f"Exception during token exchange: {e}", 500
@@ -141,18 +420,46 @@ def oauth_callback():
 
 def get_zoho_access_token():
     """
-    Uses the refresh token to obtain a new access token from Zoho.
-    Returns the new access token or None if the refresh fails.
+    Returns the cached Zoho access token, refreshing it first if it is missing
+    or within a minute of expiry. Returns None if the refresh fails.
+    """
+    token = _cached_zoho_token()
+    if token:
+        return token
+    with _TOKEN_LOCK:
+        # Another thread may have refreshed while we waited for the lock.
+        return _cached_zoho_token() or _refresh_zoho_access_token()
+
+def refresh_zoho_token():
+    """
+    Scheduled warm-up: refreshes the access token ahead of expiry so that
+    process_logs never waits on the token endpoint. get_zoho_access_token still
+    refreshes on demand if this job has not run or has failed.
     """
+    with _TOKEN_LOCK:
+        _refresh_zoho_access_token()
+
+def _cached_zoho_token():
+    """Returns the cached access token if it is valid for at least another minute."""
+    token, expires_at = _zoho_token
+    if token and time.monotonic() < expires_at - 60:
+        return token
+    return None
+
+def _refresh_zoho_access_token():
+    """
+    Uses the refresh token to obtain a new access token from Zoho and stores it
+    in the token cache. Returns the new access token or None if the refresh fails.
+    """
+    global _zoho_token
     data = {
         "refresh_token": ZOHO_REFRESH_TOKEN,
         "client_id": ZOHO_CLIENT_ID,
         "client_secret": ZOHO_CLIENT_SECRET,
         "grant_type": "refresh_token"
     }
-    token_url = "https://accounts.zoho.in/oauth/v2/token"
     try:
-        response = requests.post(token_url, data=data)
+        response = ZOHO_SESSION.post(ZOHO_TOKEN_URL, data=data, timeout=10)
     except Exception as e:
         app.logger.error("Exception during token refresh: %s", e)
         return None
@@ -162,6 +469,7 @@ def get_zoho_access_token():
             token_data = response.json()
             access_token = token_data.get("access_token")
             if access_token:
+                _zoho_token = (access_token, time.monotonic() + int(token_data.get("expires_in", 3600)))
                 app.logger.info("Obtained new Zoho access token.")
                 return access_token
             else:
@@ -174,17 +482,121 @@ def get_zoho_access_token():
         app.logger.error("Failed to refresh token: %s", response.text)
         return None
 
-def update_zoho_crm(journey):
+def _zoho_lead_fields(journey):
     """
-    Searches for an existing lead in Zoho CRM using two criteria:
-      - Mobile == journey's mobile_number
-      - Lead_Source == "WATI"
-    If found, updates only the specified fields (hardcoded field API names below).
-    Does NOT update Mobile or Lead_Source.
+    Maps a journey dict to the Zoho CRM Lead fields we update (see ZOHO_FIELD_MAP).
+    Fields the journey has no value for are left out so Zoho keeps its current value.
     """
-    mobile = journey.get("mobile_number")
-    if not mobile:
-        app.logger.error("No mobile number found in journey; cannot update Zoho CRM.")
+    return {field: journey[key] for field, key in ZOHO_FIELD_MAP if journey.get(key) is not None}
+
+def _escape_criteria_value(value):
+    """
+    Backslash-escapes the characters that are syntax in Zoho search criteria,
+    so an odd mobile string cannot split the in: list or close the clause.
+    """
+    return value.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)").replace(",", "\\,")
+
+def _mobile_key(mobile):
+    """Reduces a mobile number to its digits, so "+91 98765 43210" matches waId "919876543210"."""
+    return "".join(filter(str.isdigit, str(mobile or "")))
+
+def _search_zoho_leads(criteria, headers):
+    """
+    Runs a Leads search over every result page. Returns (leads, status), where
+    status is the HTTP status of a failed page (0 for an exception or an
+    unreadable reply) or None if every page was read.
+    """
+    leads = []
+    page = 1
+    while True:
+        params = {"criteria": criteria, "page": page, "per_page": 200}
+        try:
+            search_response = ZOHO_SESSION.get(ZOHO_SEARCH_URL, headers=headers, params=params, timeout=10)
+        except Exception as e:
+            app.logger.error("Exception during Zoho CRM search: %s", e)
+            return leads, 0
+        # Zoho answers 204 No Content when nothing matches.
+        if search_response.status_code == 204:
+            return leads, None
+        if search_response.status_code != 200:
+            app.logger.error("Error searching for leads with %s: %s", criteria, search_response.text)
+            return leads, search_response.status_code
+        try:
+            search_data = orjson.loads(search_response.content)
+        except orjson.JSONDecodeError as e:
+            app.logger.error("Unreadable Zoho CRM search response for %s: %s", criteria, e)
+            return leads, 0
+        leads.extend(search_data.get("data", []))
+        if not search_data.get("info", {}).get("more_records"):
+            return leads, None
+        page += 1
+
+def _find_zoho_lead_ids(mobiles, headers):
+    """
+    Searches for leads with Lead_Source == "WATI" whose Mobile is one of
+    mobiles (at most ZOHO_BATCH_SIZE of them) in a single search query.
+    If Zoho rejects the in: criteria, falls back to one equals search per mobile.
+    Returns {_mobile_key(mobile): record_id}; the first lead found wins for each mobile.
+    """
+    values = ",".join(_escape_criteria_value(mobile) for mobile in mobiles)
+    leads, status = _search_zoho_leads(f"((Mobile:in:{values}) and {_LEAD_SRC_CLAUSE})", headers)
+    id_by_mobile = {}
+    if status != 400:
+        for lead in leads:
+            id_by_mobile.setdefault(_mobile_key(lead.get("Mobile")), lead.get("id"))
+        return id_by_mobile
+    app.logger.warning("Zoho CRM rejected the Mobile:in: search; searching %d mobiles one by one.", len(mobiles))
+    for mobile in mobiles:
+        criteria = f"((Mobile:equals:{_escape_criteria_value(mobile)}) and {_LEAD_SRC_CLAUSE})"
+        leads = _search_zoho_leads(criteria, headers)[0]
+        # Zoho matched these on its own normalisation of Mobile, so the lead
+        # belongs to the mobile searched for, however its Mobile is formatted.
+        if leads:
+            id_by_mobile[_mobile_key(mobile)] = leads[0].get("id")
+    return id_by_mobile
+
+def _put_zoho_updates(updates, headers):
+    """Sends one bulk Leads update for a list of (mobile, fields-with-id) pairs."""
+    mobiles = [mobile for mobile, _ in updates]
+    # Serialized with orjson; numpy scalars from the journey extraction pass
+    # through as plain numbers. headers already carry the JSON Content-Type.
+    update_body = orjson.dumps({"data": [fields for _, fields in updates]}, option=orjson.OPT_SERIALIZE_NUMPY)
+    try:
+        update_response = ZOHO_SESSION.put(ZOHO_LEADS_URL, headers=headers, data=update_body, timeout=30)
+    except Exception as e:
+        app.logger.error("Exception during update call for mobiles %s: %s", mobiles, e)
+        return
+
+    if update_response.status_code not in [200, 201, 202]:
+        app.logger.error("Failed to update leads for mobiles %s: %s", mobiles, update_response.text)
+        return
+    # Zoho reports the outcome of each record in the same order it was sent.
+    try:
+        results = orjson.loads(update_response.content).get("data", [])
+    except orjson.JSONDecodeError as e:
+        app.logger.error("Unreadable update response for mobiles %s: %s", mobiles, e)
+        return
+    for mobile, result in zip(mobiles, results):
+        if result.get("status") == "success":
+            app.logger.info("Successfully updated lead for mobile %s", mobile)
+        else:
+            app.logger.error("Failed to update lead for mobile %s: %s", mobile, result)
+
+def update_zoho_crm_batch(journeys):
+    """
+    Updates the existing Zoho CRM leads for a list of journeys.
+    For every ZOHO_BATCH_SIZE mobiles, one search finds the matching leads
+    (Mobile in the batch and Lead_Source == "WATI") and one PUT updates them.
+    A mobile with several journeys is updated from its latest one. Journeys
+    without a matching lead are skipped, never created. Does NOT update
+    Mobile or Lead_Source.
+    """
+    latest = {}
+    for journey in journeys:
+        mobile = journey.get("mobile_number")
+        if mobile:
+            latest[mobile] = journey
+    if not latest:
         return
 
     access_token = get_zoho_access_token()
@@ -196,62 +608,60 @@ def update_zoho_crm(journey):
         "Authorization": "Zoho-oauthtoken " + access_token,
         "Content-Type": "application/json"
     }
-    # Search for a lead where Mobile == journey.mobile_number AND Lead_Source == "WATI"
-    criteria = f"((Mobile:equals:{mobile}) and (Lead_Source:equals:WATI))"
-    search_url = f"https://www.zohoapis.in/crm/v2/Leads/search?criteria={criteria}"
-    try:
-        search_response = requests.get(search_url, headers=headers, timeout=10)
-    except Exception as e:
-        app.logger.error("Exception during Zoho CRM search: %s", e)
-        return
+    mobiles = list(latest)
+    for i in range(0, len(mobiles), ZOHO_BATCH_SIZE):
+        chunk = mobiles[i:i + ZOHO_BATCH_SIZE]
+        id_by_mobile = _find_zoho_lead_ids(chunk, headers)
+        updates = []
+        for mobile in chunk:
+            record_id = id_by_mobile.get(_mobile_key(mobile))
+            if not record_id:
+                app.logger.info("No existing lead found for mobile %s with Lead_Source=WATI. Not creating a new entry.", mobile)
+                continue
+            fields = _zoho_lead_fields(latest[mobile])
+            if fields:
+                updates.append((mobile, {"id": record_id, **fields}))
+            else:
+                app.logger.info("No Zoho CRM fields to update for mobile %s.", mobile)
+        if updates:
+            _put_zoho_updates(updates, headers)
 
-    if search_response.status_code == 200:
-        search_data = search_response.json()
-        if "data" in search_data and len(search_data["data"]) > 0:
-            record_id = search_data["data"][0].get("id")
-            # Hardcode the mapping from journey dict -> Zoho CRM fields:
-            update_payload = {
-                "data": [{
-                    JOURNEY_ATTEMPTS_FIELD: journey.get("journey_attempts"),
-                    RENT_TENANT_CITY_FIELD: journey.get("rent_tenant_btn_city"),
-                    RENT_TENANT_CONFIG_FIELD: journey.get("rent_tenant_btn_configuration"),
-                    RENT_TENANT_CONFIG_MORE_FIELD: journey.get("rent_tenant_btn_configuration_more"),
-                    RENT_TENANT_LOCALITY_FIELD: journey.get("rent_tenant_txt_locality"),
-                    RENT_TENANT_BUDGET_WRONG_FIELD: journey.get("rent_tenant_txt_budget_wrong"),
-                    RENT_TENANT_BUDGET_CORRECT_FIELD: journey.get("rent_tenant_txt_budget_correct"),
-                    RENT_TENANT_EMAIL_FIELD: journey.get("rent_tenant_txt_email"),
-                    RENT_TENANT_EST_MOVE_IN_FIELD: journey.get("rent_tenant_btn_est_move_in")
-                    # Add more fields if needed, e.g.:
-                    # "Intro_Selection": journey.get("intro_selection"),
-                    # "Main_Selection": journey.get("main_selection"),
-                }]
-            }
-            update_url = f"https://www.zohoapis.in/crm/v2/Leads/{record_id}"
-            try:
-                update_response = requests.put(update_url, headers=headers, json=update_payload, timeout=10)
-                if update_response.status_code in [200, 201]:
-                    app.logger.info("Successfully updated lead for mobile %s", mobile)
-                else:
-                    app.logger.error("Failed to update lead for mobile %s: %s", mobile, update_response.text)
-            except Exception as e:
-                app.logger.error("Exception during update call for mobile %s: %s", mobile, e)
-        else:
-            app.logger.info("No existing lead found for mobile %s with Lead_Source=WATI. Not creating a new entry.", mobile)
-    else:
-        app.logger.error("Error searching for lead with mobile %s: %s", mobile, search_response.text)
+def update_zoho_crm(journey):
+    """
+    Searches for an existing lead in Zoho CRM using two criteria:
+      - Mobile == journey's mobile_number
+      - Lead_Source == "WATI"
+    If found, updates only the specified fields (hardcoded field API names above).
+    Does NOT update Mobile or Lead_Source.
+    """
+    if not journey.get("mobile_number"):
+        app.logger.error("No mobile number found in journey; cannot update Zoho CRM.")
+        return
+    update_zoho_crm_batch([journey])
 
 ############################################
 # Scheduled Log Processing
 ############################################
 
+def _post_journey_safe(journey):
+    """Posts one journey to Google Sheets, logging instead of raising on failure."""
+    from rentmax_analysis import post_journey_to_apps_script
+    try:
+        post_journey_to_apps_script(journey)
+    except Exception as e:
+        app.logger.error("Error posting journey to Google Sheets: %s", e)
+
 def process_logs():
     """
     Scheduled job that processes log files, extracts journey records,
     posts them to Google Sheets, and updates existing leads in Zoho CRM.
     """
+    # rentmax_analysis pulls in pandas and numpy. Importing it here rather than
+    # at module level keeps them out of the web workers that never run the
+    # scheduler; only the worker holding the scheduler lock pays for them.
+    from rentmax_analysis import process_all_files, post_journeys_to_apps_script
     app.logger.info("Starting scheduled log processing...")
-    abs_log_path = os.path.abspath(LOG_FOLDER)
-    app.logger.info("DEBUG: Searching for .txt files in: %s", abs_log_path)
+    app.logger.info("DEBUG: Searching for .txt files in: %s", LOG_FOLDER_ABS)
 
     try:
         records = process_all_files()
@@ -263,30 +673,99 @@ def process_logs():
     if not records:
         app.logger.warning("No journeys extracted. Check if the expected bot prompt is present in the logs.")
     
-    for journey in records:
-        # 1) Post journey to Google Sheets
-        try:
-            post_journey_to_apps_script(journey)
-        except Exception as e:
-            app.logger.error("Error posting journey to Google Sheets: %s", e)
-        # 2) Update the existing lead in Zoho CRM
+    # Post journeys to Google Sheets and update the existing leads in Zoho CRM
+    # at the same time; both are bound by HTTP round trips, not CPU.
+    with ThreadPoolExecutor(max_workers=SHEETS_MAX_WORKERS + 1) as executor:
+        zoho_future = executor.submit(update_zoho_crm_batch, records)
+        # One batch request when the Apps Script deployment supports it,
+        # otherwise (or if the batch certainly did not reach the script) one
+        # request per journey.
+        if not post_journeys_to_apps_script(records):
+            executor.map(_post_journey_safe, records)
         try:
-            update_zoho_crm(journey)
+            zoho_future.result()
         except Exception as e:
-            app.logger.error("Error updating journey in Zoho CRM: %s", e)
-    
+            app.logger.error("Error updating journeys in Zoho CRM: %s", e)
+
     app.logger.info("Finished processing logs.")
 
 ############################################
 # Application Startup
 ############################################
 
-if __name__ == "__main__":
+# Held open for the life of the process that owns the scheduler.
+_scheduler_lock_file = None
+
+# Wall-clock time at which the last process_logs run started; None until the
+# first run after startup.
+_last_processed_at = None
+
+def _last_write_time():
+    """Returns the time of the last log write in any worker, or 0 if none is recorded."""
+    try:
+        return os.stat(LAST_WRITE_MARKER).st_mtime
+    except FileNotFoundError:
+        return 0.0
+
+def maybe_process_logs():
+    """
+    Scheduled every PROCESS_POLL_SECONDS. Runs process_logs once on startup,
+    then only when there are writes it has not seen and the logs have been
+    quiet for PROCESS_QUIET_SECONDS (or PROCESS_MAX_DELAY_SECONDS have passed
+    since the last run, so steady traffic cannot hold processing off), plus
+    one catch-up run after SESSION_HOLD_SECONDS so a held-back last session
+    is picked up. Idle periods cost one stat(2) per poll.
+    """
+    global _last_processed_at
+    now = time.time()
+    if _last_processed_at is not None:
+        last_write = _last_write_time()
+        new_writes = last_write > _last_processed_at and (
+            now - last_write >= PROCESS_QUIET_SECONDS
+            or now - _last_processed_at >= PROCESS_MAX_DELAY_SECONDS)
+        hold_ends = last_write + SESSION_HOLD_SECONDS + SESSION_HOLD_SLACK_SECONDS
+        catch_up = _last_processed_at < hold_ends <= now
+        if not (new_writes or catch_up):
+            return
+    # Taken before processing, so writes that land during the run trigger another one.
+    _last_processed_at = now
+    process_logs()
+
+def start_scheduler():
+    """
+    Starts the background scheduler that runs process_logs after each quiet
+    period in the webhook traffic (see maybe_process_logs).
+    Called directly in development and from gunicorn's post_worker_init hook
+    (see gunicorn.conf.py). Only the first process to take the lock file in
+    LOG_FOLDER starts it; every other worker returns None, so the job never
+    runs more than once per deployment.
+    """
+    global _scheduler_lock_file
+    os.makedirs(LOG_FOLDER_ABS, exist_ok=True)
+    lock_file = open(f"{LOG_FOLDER_ABS}/.scheduler.lock", "w")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        app.logger.info("Scheduler already running in another process; not starting it in PID %s.", os.getpid())
+        return None
+    _scheduler_lock_file = lock_file
+    app.logger.info("Scheduler lock acquired by PID %s.", os.getpid())
+
     scheduler = BackgroundScheduler()
-    scheduler.add_job(func=process_logs, trigger="interval", minutes=1)
+    scheduler.add_job(func=maybe_process_logs, trigger="interval", seconds=PROCESS_POLL_SECONDS,
+                      next_run_time=datetime.now(), coalesce=True)
+    # Tokens live for an hour; refreshing every 50 minutes, starting now, keeps
+    # a valid one cached for every tick.
+    scheduler.add_job(func=refresh_zoho_token, trigger="interval", minutes=50, next_run_time=datetime.now())
     scheduler.start()
-    
+    return scheduler
+
+if __name__ == "__main__":
+    scheduler = start_scheduler()
+
     try:
         app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 5000)))
     except (KeyboardInterrupt, SystemExit):
-        scheduler.shutdown()
+        if scheduler:
+            scheduler.shutdown()
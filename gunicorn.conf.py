@@ -0,0 +1,22 @@
+# Gunicorn settings for the webhook service.
+# Start command (e.g. on Render.com):
+#   gunicorn -c gunicorn.conf.py app:app
+#
+# gevent workers keep many webhook connections open per worker instead of
+# blocking one sync worker per request. To run behind an nginx reverse proxy,
+# set GUNICORN_BIND=unix:/tmp/app.sock and point nginx at that socket.
+import multiprocessing
+import os
+
+bind = os.environ.get("GUNICORN_BIND", f"0.0.0.0:{os.environ.get('PORT', '5000')}")
+worker_class = "gevent"
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_connections = 1000
+keepalive = 5
+
+
+def post_worker_init(worker):
+    # The scheduled log processing only starts under __main__ in app.py, so
+    # offer it to each worker here; only the worker holding the lock starts it.
+    from app import start_scheduler
+    start_scheduler()
@@ -1,15 +1,42 @@
 import os
-import glob
+import functools
 import re
-import json
+import mmap
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import pandas as pd
 import numpy as np
 import requests
+import orjson
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+from urllib3.util.retry import Retry
 import pytz
 
 # Directory where the log files are stored (should be the same as in app.py)
 CHAT_FOLDER = os.environ.get("LOG_FOLDER", "logs")
 APPS_SCRIPT_URL = os.environ.get("APPS_SCRIPT_URL", "")
+# Set when the Apps Script deployment accepts {"journeys": [...]} in one POST.
+APPS_SCRIPT_BATCH = os.environ.get("APPS_SCRIPT_BATCH", "").lower() in ("1", "true", "yes")
+# Number of processes process_all_files spreads the log files over. Each one
+# imports pandas and numpy, and in a container cpu_count() is the host's, so
+# the default stays small.
+PROCESS_MAX_WORKERS = int(os.environ.get("PROCESS_MAX_WORKERS", min(4, os.cpu_count() or 1)))
+# Fewer changed files than this are parsed in-process; starting the workers
+# would cost more than parsing them.
+PROCESS_POOL_MIN_FILES = int(os.environ.get("PROCESS_POOL_MIN_FILES", 8))
+
+# Shared HTTP session for Apps Script posts. The pool is sized for the
+# concurrent posts made by app.process_logs so every thread reuses a
+# kept-alive TLS connection instead of opening its own. Retry's defaults
+# never resend a POST once it reached the server, so only failed connects
+# are retried and no journey is appended to the sheet twice.
+APPS_SCRIPT_SESSION = requests.Session()
+APPS_SCRIPT_SESSION.mount("https://", HTTPAdapter(
+    pool_maxsize=32,
+    max_retries=Retry(total=3, backoff_factor=0.5, raise_on_status=False)
+))
 
 ##########################################################
 # FLOW-SPECIFIC COLUMN DEFINITIONS (for reference)
@@ -70,362 +97,620 @@ FLOW_COLUMNS = {
 ##########################################################
 # HELPER FUNCTIONS
 ##########################################################
-def remove_emoji(text):
-    if not isinstance(text, str):
-        return text
-    pattern = re.compile("[" 
-                         u"\U0001F600-\U0001F64F"
-                         u"\U0001F300-\U0001F5FF"
-                         u"\U0001F680-\U0001F6FF"
-                         u"\U0001F1E0-\U0001F1FF"
-                         "]+", flags=re.UNICODE)
-    return pattern.sub(r'', text)
-
-def is_greeting(text):
-    greetings = {"hi", "hello", "hey", "greetings"}
-    normalized = re.sub(r'[^\w\s]', '', text.lower()).strip()
-    return normalized in greetings
-
-def filter_greetings(msgs):
-    return [msg for msg in msgs if not is_greeting(msg)]
+# One log line: "[timestamp] sender: text". Works on raw bytes with MULTILINE
+# anchors; [^\S\n] is whitespace that never crosses into the next line, and
+# the text must end in a non-space, as with the old strip-then-match parse.
+_LINE_RE = re.compile(rb"^[^\S\n]*\[(.*?)\][^\S\n](.*?):[^\S\n](.*\S)", re.MULTILINE)
+_EMOJI_RE = re.compile("["
+                       u"\U0001F600-\U0001F64F"
+                       u"\U0001F300-\U0001F5FF"
+                       u"\U0001F680-\U0001F6FF"
+                       u"\U0001F1E0-\U0001F1FF"
+                       "]+", flags=re.UNICODE)
+_PUNCT_RE = re.compile(r'[^\w\s]')
+_GREETINGS = frozenset({"hi", "hello", "hey", "greetings"})
+# Deletes the ASCII characters _PUNCT_RE removes (neither word characters nor
+# whitespace), so ASCII texts can skip the regex.
+_ASCII_PUNCT_TABLE = {c: None for c in range(128)
+                      if not (chr(c).isalnum() or chr(c) == "_" or chr(c).isspace())}
+# Bot prompt that opens every journey.
+_START_RE = re.compile(r"how can we assist you today", re.I)
+# Timestamp format written by the webhook (UTC).
+_TS_FMT = "%Y-%m-%d %H:%M:%S"
+# Epoch column value of a NaT timestamp.
+_NAT_EPOCH = np.iinfo(np.int64).min
+
+def _parse_log_timestamp(raw_ts):
+    """
+    Parses a log timestamp that is not in the webhook's "YYYY-MM-DD HH:MM:SS"
+    format into IST using pandas' format inference. Returns None if that fails.
+    """
+    ts = None
+    try:
+        # Parse raw_ts as a datetime string
+        ts = pd.to_datetime(raw_ts)
+        # If the timestamp is naive, assume it is in UTC and convert to IST.
+        if ts.tzinfo is None:
+            ts = ts.tz_localize('UTC').tz_convert('Asia/Kolkata')
+    except Exception as e:
+        print(f"Timestamp conversion failed for value '{raw_ts}': {e}", flush=True)
+        try:
+            ts = pd.to_datetime(raw_ts)
+            if ts.tzinfo is None:
+                ts = ts.tz_localize('UTC').tz_convert('Asia/Kolkata')
+            print(f"Fallback conversion succeeded for value '{raw_ts}': {ts}", flush=True)
+        except Exception as e2:
+            print(f"Fallback conversion also failed for value '{raw_ts}': {e2}", flush=True)
+            ts = None
+    return ts
+
+def line_offset_to_byte_offset(file_path, line_offset):
+    """
+    Returns the byte position just past the first line_offset lines of the
+    file. Used once per file to migrate sidecars written before offsets were
+    kept in bytes.
+    """
+    pos = 0
+    with open(file_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return pos
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for _ in range(line_offset):
+                newline = mm.find(b"\n", pos)
+                if newline == -1:
+                    return len(mm)
+                pos = newline + 1
+    return pos
 
 def parse_chat_file_from_offset(file_path, offset):
     """
-    Reads the log file starting from the given offset (line number)
-    and returns a list of messages plus the new offset (total lines read).
+    Reads the log file starting from the given byte offset and returns the
+    new messages as parallel columns, plus the new offset (just past the last
+    complete line read).
 
-    Assumes raw timestamp is a string in "YYYY-MM-DD HH:MM:SS" format.
-    If the parsed timestamp is naive, it is localized to UTC and then converted to IST.
+    The columns are "timestamp" (IST), "epoch" (UTC nanoseconds as an int64
+    numpy array), "sender", "bot" (whether the sender is the bot), "message"
+    and "end" (the offset just past the message's own line). Messages whose
+    timestamp makes the parser raise are dropped; ones it reads as NaT (an
+    empty "[]" timestamp) are kept with a NaT epoch, as before.
     """
-    pattern = r"\[(.*?)\]\s(.*?):\s(.*)"
-    messages = []
-    current_line = 0
-    with open(file_path, 'r', encoding="utf-8") as f:
-        for line in f:
-            if current_line < offset:
-                current_line += 1
-                continue
-            line = line.strip()
-            if not line:
-                current_line += 1
-                continue
-            m = re.match(pattern, line)
-            if m:
-                raw_ts, sender, text = m.groups()
-                ts = None
-                try:
-                    # Parse raw_ts as a datetime string
-                    ts = pd.to_datetime(raw_ts)
-                    # If the timestamp is naive, assume it is in UTC and convert to IST.
-                    if ts.tzinfo is None:
-                        ts = ts.tz_localize('UTC').tz_convert('Asia/Kolkata')
-                except Exception as e:
-                    print(f"Timestamp conversion failed for value '{raw_ts}': {e}", flush=True)
-                    try:
-                        ts = pd.to_datetime(raw_ts)
-                        if ts.tzinfo is None:
-                            ts = ts.tz_localize('UTC').tz_convert('Asia/Kolkata')
-                        print(f"Fallback conversion succeeded for value '{raw_ts}': {ts}", flush=True)
-                    except Exception as e2:
-                        print(f"Fallback conversion also failed for value '{raw_ts}': {e2}", flush=True)
-                        ts = None
-                messages.append({
-                    "timestamp": ts,
-                    "sender": sender.strip(),
-                    "message": text.strip()
-                })
-            current_line += 1
-    return messages, current_line
-
-def split_sessions(messages, gap_threshold=600):
+    with open(file_path, 'rb') as f:
+        if offset > os.fstat(f.fileno()).st_size:
+            print(f"DEBUG: {os.path.basename(file_path)} is shorter than its offset; reading it from the start", flush=True)
+            offset = 0
+        # The logs are append-only, so only the bytes added since the last
+        # run are read.
+        f.seek(offset)
+        tail = f.read()
+    # Stop at the last newline: a line still being appended is left for the
+    # next run instead of being counted as read.
+    tail = tail[:tail.rfind(b"\n") + 1]
+    # One C-level regex sweep over the whole tail; blank and malformed lines
+    # simply produce no match.
+    raw_timestamps, senders, bots, texts, ends = [], [], [], [], []
+    for m in _LINE_RE.finditer(tail):
+        # A stray invalid byte becomes U+FFFD instead of failing the whole file
+        # (and, with it, every later run).
+        raw_ts, sender, text = (g.decode("utf-8", "replace") for g in m.groups())
+        sender = sender.strip()
+        raw_timestamps.append(raw_ts)
+        senders.append(sender)
+        bots.append(sender.lower() == "bot")
+        texts.append(text.strip())
+        ends.append(offset + tail.index(b"\n", m.end()) + 1)
+    # Parse every timestamp in one vectorized call (cache=True parses each
+    # distinct string once). The webhook writes UTC; journeys are reported in
+    # IST. Anything not in the webhook's format goes through the slow path.
+    stamps = pd.to_datetime(raw_timestamps, format=_TS_FMT, errors='coerce', utc=True, cache=True)
+    timestamps = list(stamps.tz_convert('Asia/Kolkata'))
+    # Nanoseconds whatever resolution pandas parsed at; NaT slots are filled below.
+    epochs = stamps.values.astype("datetime64[ns]").view(np.int64)
+    dropped = False
+    for i in np.flatnonzero(stamps.isna()):
+        ts = _parse_log_timestamp(raw_timestamps[i])
+        timestamps[i] = ts
+        if ts is None:
+            dropped = True
+        else:
+            epochs[i] = ts.value
+    chat = {"timestamp": timestamps, "epoch": epochs, "sender": senders, "bot": bots,
+            "message": texts, "end": ends}
+    if dropped:
+        keep = [i for i, ts in enumerate(timestamps) if ts is not None]
+        chat = {key: ([column[i] for i in keep] if isinstance(column, list) else column[keep])
+                for key, column in chat.items()}
+    return chat, offset + len(tail)
+
+def split_sessions(chat, gap_threshold=600):
     """
-    Splits messages into sessions.
-    Filters out any messages that have an invalid timestamp.
+    Splits the parsed message columns into sessions wherever two consecutive
+    messages are more than gap_threshold seconds apart. Returns each session
+    as a (start, stop) index range into the columns, so nothing is copied.
     """
-    valid_messages = [msg for msg in messages if msg["timestamp"] is not None]
-    if not valid_messages:
+    count = len(chat["epoch"])
+    if not count:
         return []
-    
-    sessions = []
-    current = [valid_messages[0]]
-    for i in range(1, len(valid_messages)):
-        prev_ts = valid_messages[i-1]["timestamp"]
-        curr_ts = valid_messages[i]["timestamp"]
-        gap = (curr_ts - prev_ts).total_seconds()
-        if gap > gap_threshold:
-            sessions.append(current)
-            current = [valid_messages[i]]
-        else:
-            current.append(valid_messages[i])
-    if current:
-        sessions.append(current)
-    return sessions
 
+    # One vectorized diff over the epochs finds every gap.
+    epochs = chat["epoch"]
+    gaps = np.diff(epochs) > gap_threshold * 1_000_000_000
+    # A NaT epoch is int64 min; like the old Timestamp arithmetic (NaN gap),
+    # it never splits a session on either side.
+    nat = epochs == _NAT_EPOCH
+    if nat.any():
+        gaps &= ~(nat[:-1] | nat[1:])
+    splits = (np.flatnonzero(gaps) + 1).tolist()
+    bounds = [0, *splits, count]
+    return list(zip(bounds, bounds[1:]))
+
+# Keywords that pick the main menu branch, highest priority first ("sell"
+# shares the buy branch), and per branch the intro keywords that pick the
+# flow, again highest priority first.
+# Matched against the lowercased selections, like the substring checks they
+# replace. re.I would also match characters such as U+017F ("ſ") whose
+# lowercase form is not in the tables.
+_MAIN_RE = re.compile(r'rent|buy|sell|talk')
+_INTRO_RE = re.compile(r'tenant|owner|buyer|seller|channel')
+_MAIN_BRANCHES = (("rent", "rent"), ("buy", "buy"), ("sell", "buy"), ("talk", "talk"))
+_FLOW_TABLE = {
+    "rent": (("tenant", "RentTenant"), ("owner", "RentOwner"), ("channel", "ChannelPartner")),
+    "buy": (("buyer", "BuyBuyer"), ("seller", "BuySeller"), ("channel", "ChannelPartner")),
+}
+
+# Menu answers are button labels, so the same pairs repeat across journeys.
+@functools.lru_cache(maxsize=1024)
 def detect_flow(main_sel, intro_sel):
-    main_sel = main_sel.lower()
-    intro_sel = intro_sel.lower()
-    flow = None
-    if "rent" in main_sel:
-        if "tenant" in intro_sel:
-            flow = "RentTenant"
-        elif "owner" in intro_sel:
-            flow = "RentOwner"
-        elif "channel" in intro_sel:
-            flow = "ChannelPartner"
-    elif "buy" in main_sel or "sell" in main_sel:
-        if "buyer" in intro_sel:
-            flow = "BuyBuyer"
-        elif "seller" in intro_sel:
-            flow = "BuySeller"
-        elif "channel" in intro_sel:
-            flow = "ChannelPartner"
-    elif "talk" in main_sel:
-        flow = "TalkToExpert"
-    return flow
+    main_words = set(_MAIN_RE.findall(main_sel.lower()))
+    branch = next((branch for word, branch in _MAIN_BRANCHES if word in main_words), None)
+    if branch is None:
+        return None
+    if branch == "talk":
+        return "TalkToExpert"
+    intro_words = set(_INTRO_RE.findall(intro_sel.lower()))
+    for word, flow in _FLOW_TABLE[branch]:
+        if word in intro_words:
+            return flow
+    return None
 
 def validate_numeric(value):
-    return bool(re.fullmatch(r'\d+', value))
+    # isdecimal() accepts exactly the characters \d matches (Unicode category
+    # Nd); isdigit() would also let through superscripts like "²".
+    return value.isdecimal()
 
 def extract_valid_response(texts, start_index, validate_func):
-    wrong = []
-    i = start_index
-    while i < len(texts):
-        value = texts[i]
-        if validate_func(value):
-            return value, i + 1, wrong
-        else:
-            wrong.append(value)
-            i += 1
-    return None, i, wrong
+    # Index of the first valid answer; everything before it is a wrong attempt.
+    end = max(start_index, len(texts))
+    found = next((i for i in range(start_index, end) if validate_func(texts[i])), end)
+    wrong = texts[start_index:found]
+    if found < end:
+        return texts[found], found + 1, wrong
+    return None, found, wrong
 
-def extract_journeys_from_session(session, file_name):
+##########################################################
+# FLOW STEPS
+##########################################################
+# Each step reads the user's answer(s) at texts[pointer], stores them in the
+# journey record and returns the pointer to the next unread answer. A step
+# whose answer was never given leaves the record and the pointer untouched.
+
+def _take(field):
+    def step(record, texts, pointer):
+        if pointer < len(texts):
+            record[field] = texts[pointer]
+            pointer += 1
+        return pointer
+    return step
+
+def _take_with_more(field, more_field):
+    # Button answer where "More" is followed by a second answer.
+    def step(record, texts, pointer):
+        if pointer < len(texts):
+            value = texts[pointer]
+            record[field] = value
+            pointer += 1
+            if value.lower() == "more" and pointer < len(texts):
+                record[more_field] = texts[pointer]
+                pointer += 1
+        return pointer
+    return step
+
+def _take_numeric(correct_field, wrong_field):
+    # Skips answers until a numeric one; the skipped ones are kept as wrong.
+    def step(record, texts, pointer):
+        if pointer < len(texts):
+            valid, pointer, wrongs = extract_valid_response(texts, pointer, validate_numeric)
+            record[correct_field] = valid
+            record[wrong_field] = "; ".join(wrongs) if wrongs else None
+        return pointer
+    return step
+
+def _take_if_previous(field, *keywords):
+    # Only asked when the answer just taken contains one of the keywords. If
+    # answers remain, the previous step did take one, at texts[pointer - 1].
+    def step(record, texts, pointer):
+        if pointer < len(texts):
+            previous = texts[pointer - 1].lower()
+            if any(keyword in previous for keyword in keywords):
+                record[field] = texts[pointer]
+                pointer += 1
+        return pointer
+    return step
+
+def _peek(field):
+    # Always set (empty if missing), and the answer is also kept in extra_responses.
+    def step(record, texts, pointer):
+        record[field] = texts[pointer] if pointer < len(texts) else ""
+        return pointer
+    return step
+
+FLOW_STEPS = {
+    "TalkToExpert": (
+        _peek("message"),
+    ),
+    "RentTenant": (
+        _take("rent_tenant_btn_city"),
+        _take_with_more("rent_tenant_btn_configuration", "rent_tenant_btn_configuration_more"),
+        _take("rent_tenant_txt_locality"),
+        _take_numeric("rent_tenant_txt_budget_correct", "rent_tenant_txt_budget_wrong"),
+        _take("rent_tenant_txt_email"),
+        _take("rent_tenant_btn_est_move_in"),
+    ),
+    "RentOwner": (
+        _take("rent_owner_btn_city"),
+        _take_with_more("rent_owner_btn_configuration", "rent_owner_btn_configuration_more"),
+        _take("rent_owner_txt_locality"),
+        _take_numeric("rent_owner_txt_rent_expectation_correct", "rent_owner_txt_rent_expectation_wrong"),
+    ),
+    "BuyBuyer": (
+        _take_with_more("buy_buyer_btn_configuration", "buy_buyer_btn_configuration_more"),
+        _take("buy_buyer_txt_locality"),
+        _take_numeric("buy_buyer_txt_budget_correct", "buy_buyer_txt_budget_wrong"),
+        _take("buy_buyer_txt_email"),
+    ),
+    "BuySeller": (
+        _take_with_more("buy_seller_btn_configuration", "buy_seller_btn_configuration_more"),
+        _take("buy_seller_txt_locality"),
+        _take_numeric("buy_seller_txt_sale_expectation_correct", "buy_seller_txt_sale_expectation_wrong"),
+        _take("buy_seller_txt_email"),
+    ),
+    "ChannelPartner": (
+        _take("cp_mode_of_operation"),
+        _take_if_previous("cp_name", "firm", "company"),
+        _take("cp_area_expertise"),
+        _take("cp_office_location"),
+        _take("cp_rera_registered"),
+        _take_if_previous("cp_rera_info", "yes"),
+    ),
+}
+
+def remove_emoji(text):
+    # Every emoji range is outside ASCII, so plain-text answers skip the regex.
+    if text.isascii():
+        return text
+    # Short texts are mostly button labels that recur across chats; long ones
+    # are free text and would only churn the cache.
+    if len(text) <= 64:
+        return _remove_emoji_cached(text)
+    return _EMOJI_RE.sub('', text)
+
+@functools.lru_cache(maxsize=4096)
+def _remove_emoji_cached(text):
+    return _EMOJI_RE.sub('', text)
+
+def _is_greeting(text):
+    lowered = text.lower()
+    # Bare greetings have no punctuation to strip.
+    if lowered.strip() in _GREETINGS:
+        return True
+    if lowered.isascii():
+        return lowered.translate(_ASCII_PUNCT_TABLE).strip() in _GREETINGS
+    return _PUNCT_RE.sub('', lowered).strip() in _GREETINGS
+
+def extract_journeys_from_session(chat, start, stop, file_name, mobile_number=None):
+    """Extracts the journeys from the session chat[start:stop] (see split_sessions)."""
+    timestamps = chat["timestamp"]
+    senders = chat["sender"]
+    bots = chat["bot"]
+    messages = chat["message"]
     journeys = []
-    journey_start_indices = []
-    for idx, msg in enumerate(session):
-        if msg["sender"].lower() == "bot" and "how can we assist you today" in msg["message"].lower():
-            journey_start_indices.append(idx)
+    journey_start_indices = [idx for idx in range(start, stop)
+                             if bots[idx] and _START_RE.search(messages[idx])]
     if not journey_start_indices:
         print(f"DEBUG: No journey start prompt found in file: {file_name}", flush=True)
         return journeys
 
     for k, start_idx in enumerate(journey_start_indices):
-        end_idx = journey_start_indices[k+1] if (k+1 < len(journey_start_indices)) else len(session)
-        segment_msgs = session[start_idx:end_idx]
-        non_bot = [msg for msg in segment_msgs if msg["sender"].lower() != "bot"]
-        if not non_bot:
-            continue
-        texts = [remove_emoji(msg["message"]).strip() for msg in non_bot]
-        texts = filter_greetings(texts)
+        end_idx = journey_start_indices[k+1] if (k+1 < len(journey_start_indices)) else stop
+        # One pass over the segment: skip bot messages, strip emoji and
+        # whitespace, and drop bare greetings ("hi", "hello!", ...).
+        username = None
+        texts = []
+        for idx in range(start_idx, end_idx):
+            if bots[idx]:
+                continue
+            if username is None:
+                username = senders[idx]
+            text = remove_emoji(messages[idx]).strip()
+            if not _is_greeting(text):
+                texts.append(text)
         if len(texts) < 1:
             continue
 
         main_sel = texts[0]
         intro_sel = texts[1] if len(texts) > 1 else ""
         flow = detect_flow(main_sel, intro_sel) or "Unknown"
-        username = non_bot[0]["sender"]
 
         journey_record = {
             "file": file_name,
             "username": username,
             "flow": flow,
-            "journey_start": session[start_idx]["timestamp"],
-            "journey_end": session[end_idx-1]["timestamp"],
+            "journey_start": timestamps[start_idx],
+            "journey_end": timestamps[end_idx-1],
             "total_messages": end_idx - start_idx,
             "main_selection": main_sel,
             "intro_selection": intro_sel,
-            "extra_responses": ""
+            "extra_responses": "",
+            "mobile_number": mobile_number
         }
 
         pointer = 2
-        if flow == "TalkToExpert":
-            journey_record["message"] = texts[pointer] if pointer < len(texts) else ""
-        elif flow == "RentTenant":
-            if pointer < len(texts):
-                journey_record["rent_tenant_btn_city"] = texts[pointer]
-                pointer += 1
-            if pointer < len(texts):
-                apt_type = texts[pointer]
-                journey_record["rent_tenant_btn_configuration"] = apt_type
-                pointer += 1
-                if apt_type.lower() == "more" and pointer < len(texts):
-                    journey_record["rent_tenant_btn_configuration_more"] = texts[pointer]
-                    pointer += 1
-            if pointer < len(texts):
-                journey_record["rent_tenant_txt_locality"] = texts[pointer]
-                pointer += 1
-            if pointer < len(texts):
-                valid_budget, new_ptr, wrongs = extract_valid_response(texts, pointer, validate_numeric)
-                journey_record["rent_tenant_txt_budget_correct"] = valid_budget
-                journey_record["rent_tenant_txt_budget_wrong"] = "; ".join(wrongs) if wrongs else None
-                pointer = new_ptr
-            if pointer < len(texts):
-                journey_record["rent_tenant_txt_email"] = texts[pointer]
-                pointer += 1
-            if pointer < len(texts):
-                journey_record["rent_tenant_btn_est_move_in"] = texts[pointer]
-                pointer += 1
-        elif flow == "RentOwner":
-            if pointer < len(texts):
-                journey_record["rent_owner_btn_city"] = texts[pointer]
-                pointer += 1
-            if pointer < len(texts):
-                apt_size = texts[pointer]
-                journey_record["rent_owner_btn_configuration"] = apt_size
-                pointer += 1
-                if apt_size.lower() == "more" and pointer < len(texts):
-                    journey_record["rent_owner_btn_configuration_more"] = texts[pointer]
-                    pointer += 1
-            if pointer < len(texts):
-                journey_record["rent_owner_txt_locality"] = texts[pointer]
-                pointer += 1
-            if pointer < len(texts):
-                valid_expect, new_ptr, wrongs = extract_valid_response(texts, pointer, validate_numeric)
-                journey_record["rent_owner_txt_rent_expectation_correct"] = valid_expect
-                journey_record["rent_owner_txt_rent_expectation_wrong"] = "; ".join(wrongs) if wrongs else None
-                pointer = new_ptr
-        elif flow == "BuyBuyer":
-            if pointer < len(texts):
-                apt_size = texts[pointer]
-                journey_record["buy_buyer_btn_configuration"] = apt_size
-                pointer += 1
-                if apt_size.lower() == "more" and pointer < len(texts):
-                    journey_record["buy_buyer_btn_configuration_more"] = texts[pointer]
-                    pointer += 1
-            if pointer < len(texts):
-                journey_record["buy_buyer_txt_locality"] = texts[pointer]
-                pointer += 1
-            if pointer < len(texts):
-                valid_budget, new_ptr, wrongs = extract_valid_response(texts, pointer, validate_numeric)
-                journey_record["buy_buyer_txt_budget_correct"] = valid_budget
-                journey_record["buy_buyer_txt_budget_wrong"] = "; ".join(wrongs) if wrongs else None
-                pointer = new_ptr
-            if pointer < len(texts):
-                journey_record["buy_buyer_txt_email"] = texts[pointer]
-                pointer += 1
-        elif flow == "BuySeller":
-            if pointer < len(texts):
-                apt_size = texts[pointer]
-                journey_record["buy_seller_btn_configuration"] = apt_size
-                pointer += 1
-                if apt_size.lower() == "more" and pointer < len(texts):
-                    journey_record["buy_seller_btn_configuration_more"] = texts[pointer]
-                    pointer += 1
-            if pointer < len(texts):
-                journey_record["buy_seller_txt_locality"] = texts[pointer]
-                pointer += 1
-            if pointer < len(texts):
-                valid_sale, new_ptr, wrongs = extract_valid_response(texts, pointer, validate_numeric)
-                journey_record["buy_seller_txt_sale_expectation_correct"] = valid_sale
-                journey_record["buy_seller_txt_sale_expectation_wrong"] = "; ".join(wrongs) if wrongs else None
-                pointer = new_ptr
-            if pointer < len(texts):
-                journey_record["buy_seller_txt_email"] = texts[pointer]
-                pointer += 1
-        elif flow == "ChannelPartner":
-            if pointer < len(texts):
-                journey_record["cp_mode_of_operation"] = texts[pointer]
-                pointer += 1
-            mode = journey_record.get("cp_mode_of_operation", "").lower()
-            if "firm" in mode or "company" in mode:
-                if pointer < len(texts):
-                    journey_record["cp_name"] = texts[pointer]
-                    pointer += 1
-            if pointer < len(texts):
-                journey_record["cp_area_expertise"] = texts[pointer]
-                pointer += 1
-            if pointer < len(texts):
-                journey_record["cp_office_location"] = texts[pointer]
-                pointer += 1
-            if pointer < len(texts):
-                journey_record["cp_rera_registered"] = texts[pointer]
-                pointer += 1
-            if "yes" in journey_record.get("cp_rera_registered", "").lower():
-                if pointer < len(texts):
-                    journey_record["cp_rera_info"] = texts[pointer]
-                    pointer += 1
-        elif flow == "TalkToExpert":
-            journey_record["message"] = texts[pointer] if pointer < len(texts) else ""
+        for step in FLOW_STEPS.get(flow, ()):
+            pointer = step(journey_record, texts, pointer)
         if pointer < len(texts):
             journey_record["extra_responses"] = "; ".join(texts[pointer:])
         journeys.append(journey_record)
     return journeys
 
+def read_offset_file(offset_file):
+    """Returns the contents of an .offset sidecar, or {} if there is none or it is unreadable."""
+    try:
+        with open(offset_file, "rb") as f:
+            return orjson.loads(f.read())
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        print(f"Error reading offset file {offset_file}: {e}", flush=True)
+        return {}
+
+def write_offset_file(offset_file, offset_info):
+    # Write a temp file and rename it over the sidecar, so a crash mid-write
+    # leaves the previous offsets intact instead of a truncated JSON file.
+    tmp_file = offset_file + ".tmp"
+    try:
+        with open(tmp_file, "wb") as f:
+            f.write(orjson.dumps(offset_info))
+        os.replace(tmp_file, offset_file)
+    except Exception as e:
+        print(f"Error writing offset file {offset_file}: {e}", flush=True)
+
 def process_file(file_path):
+    """
+    Extracts the journeys added to a log file since the last run.
+
+    Progress is kept as a byte offset in a "<file>.offset" JSON sidecar, so
+    only the bytes appended since the last run are read. Once a file has been
+    consumed with no session held back, the sidecar also records the file's
+    mtime, and the file is skipped without being read until it changes again.
+    """
+    file_records, offset_info = _read_new_journeys(file_path)
+    if offset_info is not None:
+        write_offset_file(file_path + ".offset", offset_info)
+    return file_records
+
+def _read_new_journeys(file_path):
+    """
+    The work of process_file without writing the sidecar: returns the new
+    journeys and the sidecar contents to write once they have been taken
+    (None if the file is unchanged).
+    """
     offset_file = file_path + ".offset"
-    start_line = 0
-    journey_count = 0
-    if os.path.exists(offset_file):
-        try:
-            with open(offset_file, "r") as f:
-                offset_data = json.load(f)
-                start_line = offset_data.get("line_offset", 0)
-                journey_count = offset_data.get("journey_count", 0)
-        except Exception as e:
-            print(f"Error reading offset file {offset_file}: {e}", flush=True)
-    messages, new_offset = parse_chat_file_from_offset(file_path, start_line)
-    if not messages:
-        return []
+    offset_data = read_offset_file(offset_file)
+    start_offset = offset_data.get("byte_offset") if offset_data else 0
+    legacy_line_offset = offset_data.get("line_offset", 0)
+    journey_count = offset_data.get("journey_count", 0)
+    seen_mtime_ns = offset_data.get("mtime_ns")
+    # Stat before reading so a write racing with this run changes the mtime
+    # again and the file is picked up on the next run.
+    mtime_ns = os.stat(file_path).st_mtime_ns
+    if mtime_ns == seen_mtime_ns:
+        return [], None
+    if start_offset is None:
+        # Sidecar from before byte offsets; convert its line count once.
+        start_offset = line_offset_to_byte_offset(file_path, legacy_line_offset)
+    chat, new_offset = parse_chat_file_from_offset(file_path, start_offset)
+    if not chat["end"]:
+        return [], {"byte_offset": new_offset, "journey_count": journey_count, "mtime_ns": mtime_ns}
     
-    sessions = split_sessions(messages)
+    sessions = split_sessions(chat)
     
     # Hold the last session if its last message is less than 7 minutes old.
     now = pd.Timestamp.now(tz='Asia/Kolkata')
     threshold = now - pd.Timedelta(minutes=7)
     complete_sessions = []
+    held = False
     for i, session in enumerate(sessions):
         if i == len(sessions) - 1:
-            if session[-1]["timestamp"] <= threshold:
+            if chat["timestamp"][session[1] - 1] <= threshold:
                 complete_sessions.append(session)
             else:
                 print(f"DEBUG: Holding incomplete session in file: {os.path.basename(file_path)}", flush=True)
+                held = True
                 break
         else:
             complete_sessions.append(session)
     
-    lines_processed = sum(len(s) for s in complete_sessions)
+    # The mobile number is the file name without its .txt (or .done) suffix.
+    file_name = os.path.basename(file_path)
+    mobile = file_name.replace(".done", "").replace(".txt", "")
     file_records = []
-    new_journeys = 0
-    for session in complete_sessions:
-        recs = extract_journeys_from_session(session, os.path.basename(file_path))
-        if recs:
-            new_journeys += len(recs)
-            file_records.extend(recs)
+    for start, stop in complete_sessions:
+        file_records.extend(extract_journeys_from_session(chat, start, stop, file_name, mobile))
     
-    final_offset = start_line + lines_processed
-    journey_count += new_journeys
-    offset_info = {"line_offset": final_offset, "journey_count": journey_count}
-    try:
-        with open(offset_file, "w") as f:
-            json.dump(offset_info, f)
-    except Exception as e:
-        print(f"Error writing offset file {offset_file}: {e}", flush=True)
-    
-    # Extract mobile number from file name (remove any .done suffix)
-    base_name = os.path.basename(file_path).replace(".done", "")
-    mobile = base_name.replace(".txt", "")
+    # Resume after the last message handled. Counting messages instead would
+    # drift on every blank or malformed line in the file.
+    if not held:
+        final_offset = new_offset
+    elif complete_sessions:
+        final_offset = chat["end"][complete_sessions[-1][1] - 1]
+    else:
+        final_offset = start_offset
+    journey_count += len(file_records)
+    # A held session must be looked at again once it is old enough, even if
+    # the file does not change, so only record the mtime when nothing is held.
+    offset_info = {"byte_offset": final_offset, "journey_count": journey_count,
+                   "mtime_ns": None if held else mtime_ns}
+
+    # The attempt count covers this run's journeys too, so it is only known now.
     for rec in file_records:
-        rec["mobile_number"] = mobile
         rec["no_of_attempts"] = journey_count
-    return file_records
+    return file_records, offset_info
+
+def _log_file_changed(file_path):
+    """True unless the file's sidecar records its current mtime (see process_file)."""
+    try:
+        mtime_ns = os.stat(file_path).st_mtime_ns
+    except FileNotFoundError:
+        return False
+    return read_offset_file(file_path + ".offset").get("mtime_ns") != mtime_ns
+
+def _process_file_logged(file_path):
+    """
+    process_file, logging instead of raising, so one bad file cannot abort a
+    run after other files' sidecars have been advanced (their journeys would
+    then be lost). The failed file's sidecar is untouched and it is retried.
+    """
+    try:
+        return process_file(file_path)
+    except Exception as e:
+        print(f"Error processing {file_path}: {e!r}", flush=True)
+        return []
+
+def _read_new_journeys_logged(file_path):
+    """_read_new_journeys for the pool workers, logging instead of raising."""
+    try:
+        return _read_new_journeys(file_path)
+    except Exception as e:
+        print(f"Error processing {file_path}: {e!r}", flush=True)
+        return [], None
 
 def process_all_files():
+    """
+    Runs process_file over every log file that changed since the last run and
+    returns all new journeys. Files are independent (each has its own .offset
+    sidecar), so when many changed they are parsed in parallel across up to
+    PROCESS_MAX_WORKERS processes, started for this run only.
+    """
     all_records = []
-    file_paths = glob.glob(os.path.join(CHAT_FOLDER, "*.txt"))
+    # scandir gets the entry type from the directory listing itself, so no
+    # file is stat'ed here; only the logs themselves are.
+    try:
+        with os.scandir(CHAT_FOLDER) as entries:
+            file_paths = [entry.path for entry in entries
+                          if entry.name.endswith(".txt") and not entry.name.startswith(".") and entry.is_file()]
+    except FileNotFoundError:
+        # Nothing has been logged yet.
+        file_paths = []
     print("DEBUG: Searching for .txt files in:", os.path.abspath(CHAT_FOLDER), flush=True)
     print("DEBUG: Found files:", file_paths, flush=True)
-    for file_path in file_paths:
-        recs = process_file(file_path)
-        all_records.extend(recs)
+    file_paths = [file_path for file_path in file_paths if _log_file_changed(file_path)]
+    workers = min(PROCESS_MAX_WORKERS, len(file_paths))
+    if workers < 2 or len(file_paths) < PROCESS_POOL_MIN_FILES:
+        for file_path in file_paths:
+            all_records.extend(_process_file_logged(file_path))
+        return all_records
+    # spawn rather than fork: the caller is a scheduler thread inside a
+    # threaded web worker, whose locks must not be copied mid-use. The pool is
+    # shut down when the run ends so no idle workers stay resident.
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        futures = [(file_path, pool.submit(_read_new_journeys_logged, file_path)) for file_path in file_paths]
+        # Workers leave the sidecars alone; each one is advanced here only
+        # once its journeys are in hand. If a worker dies (OOM, a signal), the
+        # pool fails every unfinished future, and those files keep their old
+        # sidecars and are read again next run instead of losing journeys.
+        for file_path, future in futures:
+            try:
+                file_records, offset_info = future.result()
+            except BrokenProcessPool as e:
+                print(f"Error processing {file_path}: {e!r}", flush=True)
+                continue
+            if offset_info is not None:
+                write_offset_file(file_path + ".offset", offset_info)
+            all_records.extend(file_records)
     return all_records
 
+# orjson hands datetimes to _sheets_json_default instead of writing ISO 8601,
+# and writes numpy scalars as plain numbers.
+_SHEETS_JSON_OPTIONS = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_SERIALIZE_NUMPY
+
+def _sheets_json_default(value):
+    # Timestamps go to Google Sheets as "YYYY-MM-DD HH:MM:SS".
+    if hasattr(value, "strftime"):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def _post_to_apps_script(payload, timeout=10):
+    """POSTs payload as JSON to APPS_SCRIPT_URL without modifying it; returns the response."""
+    body = orjson.dumps(payload, default=_sheets_json_default, option=_SHEETS_JSON_OPTIONS)
+    return APPS_SCRIPT_SESSION.post(APPS_SCRIPT_URL, data=body,
+                                    headers={"Content-Type": "application/json"}, timeout=timeout)
+
+def _never_connected(error):
+    """
+    True if a requests ConnectionError was raised before a connection was made
+    (connect timeout, refused connection, name resolution), so nothing was sent.
+    Other ConnectionErrors, such as a dropped connection, can follow a fully
+    sent request.
+    """
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = error.args[0] if error.args else None
+    reason = getattr(reason, "reason", reason)
+    return isinstance(reason, NewConnectionError)
+
+def post_journeys_to_apps_script(journeys):
+    """
+    Posts all journeys to Apps Script in a single request when APPS_SCRIPT_BATCH
+    is set. Returns False only when the batch was certainly not processed
+    (batching is off, no connection could be made or the reply was a 4xx); the
+    caller should then fall back to post_journey_to_apps_script for each
+    journey. Once the request may have reached the script (a dropped
+    connection, a read timeout, a 5xx or an unexpected reply), the failure is
+    logged and True is returned, since posting again could append every row
+    twice.
+    """
+    if not APPS_SCRIPT_BATCH or not journeys:
+        return False
+    try:
+        response = _post_to_apps_script({"journeys": journeys}, timeout=60)
+    except TypeError as e:
+        # Not serializable, so nothing was sent.
+        print(f"Exception posting journey batch to Apps Script: {e}", flush=True)
+        return False
+    except Exception as e:
+        if isinstance(e, requests.exceptions.ConnectionError) and _never_connected(e):
+            print(f"Exception posting journey batch to Apps Script: {e}", flush=True)
+            return False
+        print(f"Exception posting journey batch to Apps Script; not re-posting {len(journeys)} journeys: {e}", flush=True)
+        return True
+    if 400 <= response.status_code < 500:
+        print(f"Apps Script batch post failed ({response.status_code}): {response.text}", flush=True)
+        return False
+    if response.status_code != 200:
+        print(f"Apps Script batch post failed ({response.status_code}); not re-posting {len(journeys)} journeys: {response.text}", flush=True)
+        return True
+    try:
+        result = response.json().get("result")
+    except Exception:
+        result = None
+    if result == "success":
+        print(f"Successfully posted {len(journeys)} journeys to Apps Script.", flush=True)
+    else:
+        print(f"Unexpected Apps Script batch reply; not re-posting {len(journeys)} journeys: {response.text}", flush=True)
+    return True
+
 def post_journey_to_apps_script(journey):
-    # Convert any Timestamp/datetime objects to a string format recognized by Google Sheets.
-    # Format: "YYYY-MM-DD HH:MM:SS"
-    for key, value in journey.items():
-        if hasattr(value, "strftime"):
-            journey[key] = value.strftime('%Y-%m-%d %H:%M:%S')
     try:
-        response = requests.post(APPS_SCRIPT_URL, json=journey, timeout=10)
+        response = _post_to_apps_script(journey)
         print("Response status code:", response.status_code, flush=True)
         print("Response text:", response.text, flush=True)
         if response.status_code == 200:
@@ -446,8 +731,9 @@ def post_journey_to_apps_script(journey):
 def main():
     records = process_all_files()
     print("DEBUG: Total records extracted:", len(records), flush=True)
-    for journey in records:
-        post_journey_to_apps_script(journey)
+    if not post_journeys_to_apps_script(records):
+        for journey in records:
+            post_journey_to_apps_script(journey)
 
 if __name__ == "__main__":
     main()